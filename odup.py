@@ -32,87 +32,327 @@
 # ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
+import heapq
 import logging
+import Queue
+import random
 import re
+import select
+import socket
+import sqlite3
+import struct
+import sys
+import threading
+import time
 
-import dns.name, dns.resolver, dns.rdatatype, dns.zone
+import dns.exception, dns.flags, dns.inet, dns.message, dns.name, dns.query, \
+        dns.rcode, dns.rdataclass, dns.rdatatype, dns.rdtypes.ANY.TXT, dns.resolver
+
+import odup2psl
 
 ODUP_VERS1 = re.compile(r'^v=odup1(\s|$)')
 ORG_RE = re.compile(r'(^|\s)\+org(:\S+)?(\s|$)')
 BOUND_RE = re.compile(r'(^|\s)\+bound(:(?P<labels>\d+))?(\s|$)')
+FETCH_RE = re.compile(r'(^|\s)\+fetch:(?P<uri>\S+)')
+
+def _sizeof(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    return sys.getsizeof(obj)
+
+class _PolicyNode(object):
+    # A node in the tree of names in a policy realm.  Its existence means
+    # that the name exists; policy is None if it has no ODUP policy.
+    # Children are keyed by lower-cased, interned label.
+    __slots__ = ('policy', 'children')
+
+    def __init__(self):
+        self.policy = None
+        self.children = None
+
+    def get_child(self, label):
+        if self.children is None:
+            return None
+        return self.children.get(label.lower())
+
+    def add_child(self, label):
+        if self.children is None:
+            self.children = {}
+        label = intern(label.lower())
+        try:
+            return self.children[label]
+        except KeyError:
+            child = self.children[label] = _PolicyNode()
+            return child
+
+_TTL_RE = re.compile(r'^\d[\dsmhdwSMHDW]*$')
+_CLASSES = ('IN', 'CH', 'CS', 'HS', 'ANY', 'NONE')
+_ESCAPE_RE = re.compile(r'\\(\d{3}|.)')
+
+def _unescape(text):
+    return _ESCAPE_RE.sub(lambda m: chr(int(m.group(1))) if len(m.group(1)) == 3 else m.group(1), text)
+
+def _txt_to_text(strings):
+    # Equivalent to rdata.to_text().strip('"') for a TXT rdata holding the
+    # given strings, which is how policies are read from DNS responses.
+    out = []
+    for string in strings:
+        chars = []
+        for c in string:
+            if c in '"\\':
+                chars.append('\\' + c)
+            elif 0x20 <= ord(c) < 0x7f:
+                chars.append(c)
+            else:
+                chars.append('\\%03d' % ord(c))
+        out.append(''.join(chars))
+    return '" "'.join(out)
+
+def _tokenize_master_file(fh, filename):
+    # Yield a tuple of (line number, owner omitted, tokens) for each entry in
+    # the master file, joining lines within parentheses.  Comments are
+    # dropped, and quoted strings are returned with the quotes removed but
+    # escapes intact.
+    tokens = []
+    depth = 0
+    start = None
+    owner_omitted = False
+    for lineno, line in enumerate(fh, 1):
+        if depth == 0:
+            tokens = []
+            start = lineno
+            owner_omitted = line[:1] in (' ', '\t')
+
+        i = 0
+        n = len(line)
+        while i < n:
+            c = line[i]
+            if c in ' \t\r\n':
+                i += 1
+            elif c == ';':
+                break
+            elif c == '(':
+                depth += 1
+                i += 1
+            elif c == ')':
+                depth -= 1
+                if depth < 0:
+                    raise dns.exception.SyntaxError('%s:%d: unbalanced parentheses' % (filename, lineno))
+                i += 1
+            elif c == '"':
+                j = i + 1
+                while j < n and line[j] != '"':
+                    if line[j] == '\\':
+                        j += 1
+                    j += 1
+                if j >= n:
+                    raise dns.exception.SyntaxError('%s:%d: unterminated quoted string' % (filename, lineno))
+                tokens.append(line[i+1:j])
+                i = j + 1
+            else:
+                j = i
+                while j < n and line[j] not in ' \t\r\n;()"':
+                    if line[j] == '\\':
+                        j += 1
+                    j += 1
+                tokens.append(line[i:j])
+                i = j
+
+        if depth == 0 and tokens:
+            yield start, owner_omitted, tokens
+
+    if depth > 0:
+        raise dns.exception.SyntaxError('%s:%d: unbalanced parentheses' % (filename, start))
+
+_GENERATE_RANGE_RE = re.compile(r'^(?P<start>\d+)-(?P<stop>\d+)(/(?P<step>\d+))?$')
+_GENERATE_RE = re.compile(r'\\\$|\$(\{(?P<offset>[+-]?\d+)(,(?P<width>\d+)(,(?P<base>[doxX]))?)?\})?')
+
+def _generate_text(template, i):
+    # Substitute i into a $GENERATE template, as BIND does: $ is replaced by
+    # i, ${offset[,width[,base]]} by i plus offset in the given width and
+    # base, and \$ by a literal $.
+    def _replace(m):
+        if m.group(0) == '\\$':
+            return '$'
+        value = i + int(m.group('offset') or 0)
+        return ('%0*' + (m.group('base') or 'd')) % (int(m.group('width') or 0), value)
+    return _GENERATE_RE.sub(_replace, template)
+
+def _split_type(tokens, filename, lineno):
+    # Skip the TTL and class, which may appear in either order, and return
+    # a tuple of the record type and the remaining tokens.
+    while tokens and (_TTL_RE.search(tokens[0]) is not None or tokens[0].upper() in _CLASSES):
+        tokens = tokens[1:]
+    if not tokens:
+        raise dns.exception.SyntaxError('%s:%d: no record type' % (filename, lineno))
+    return dns.rdatatype.from_text(tokens[0]), tokens[1:]
+
+def _policy_from_strings(strings):
+    policy = _txt_to_text([_unescape(t) for t in strings])
+    if ODUP_VERS1.search(policy) is None:
+        return None
+    return policy
+
+def _iterate_master_file(filename, origin, current_origin=None):
+    # Yield a tuple of (name, policy) for each record in the master file,
+    # with name relative to origin.  policy is None for records that are not
+    # ODUP policies.  Only what is needed for policy realms is interpreted,
+    # so records are never materialized as rdata.
+    if current_origin is None:
+        current_origin = origin
+    owner = None
+    with open(filename) as fh:
+        for lineno, owner_omitted, tokens in _tokenize_master_file(fh, filename):
+            if tokens[0].startswith('$'):
+                directive = tokens[0].upper()
+                if directive == '$ORIGIN':
+                    current_origin = dns.name.from_text(tokens[1], current_origin)
+                elif directive == '$INCLUDE':
+                    if len(tokens) > 2:
+                        include_origin = dns.name.from_text(tokens[2], current_origin)
+                    else:
+                        include_origin = current_origin
+                    for name, policy in _iterate_master_file(tokens[1], origin, include_origin):
+                        yield name, policy
+                elif directive == '$GENERATE':
+                    # $GENERATE range lhs [ttl] [class] type rhs
+                    if len(tokens) < 4:
+                        raise dns.exception.SyntaxError('%s:%d: bad $GENERATE' % (filename, lineno))
+                    m = _GENERATE_RANGE_RE.search(tokens[1])
+                    if m is None:
+                        raise dns.exception.SyntaxError('%s:%d: bad $GENERATE range %s' % (filename, lineno, tokens[1]))
+                    rdtype, rhs = _split_type(tokens[3:], filename, lineno)
+                    for i in range(int(m.group('start')), int(m.group('stop')) + 1, int(m.group('step') or 1)):
+                        owner = dns.name.from_text(_generate_text(tokens[2], i), current_origin)
+                        if not owner.is_subdomain(origin):
+                            continue
+                        policy = None
+                        if rdtype == dns.rdatatype.TXT:
+                            policy = _policy_from_strings([_generate_text(t, i) for t in rhs])
+                        yield owner.relativize(origin), policy
+                elif directive != '$TTL':
+                    raise dns.exception.SyntaxError('%s:%d: unsupported directive %s' % (filename, lineno, tokens[0]))
+                continue
+
+            if not owner_omitted:
+                if tokens[0] == '@':
+                    owner = current_origin
+                else:
+                    owner = dns.name.from_text(tokens[0], current_origin)
+                tokens = tokens[1:]
+            elif owner is None:
+                raise dns.exception.SyntaxError('%s:%d: no owner name' % (filename, lineno))
+            # like dns.zone, ignore records outside the zone, such as glue
+            if not owner.is_subdomain(origin):
+                continue
+
+            rdtype, rdata = _split_type(tokens, filename, lineno)
+            policy = None
+            if rdtype == dns.rdatatype.TXT:
+                policy = _policy_from_strings(rdata)
+            yield owner.relativize(origin), policy
 
 class ODUPPolicyRealm(object):
+    __slots__ = ('origin', '_root')
+
     def __init__(self, origin):
         self.origin = origin
         assert self.origin.is_absolute()
 
-        self._policies = {}
+        self._root = _PolicyNode()
 
     @classmethod
     def from_file(cls, origin, filename):
-        z = dns.zone.from_file(filename, dns.name.from_text('_odup', origin))
-
         obj = ODUPPolicyRealm(origin)
-        for name, ttl, rdata in z.iterate_rdatas():
-            obj.add_policy_from_rdata(name, rdata)
+        for name, policy in _iterate_master_file(filename, dns.name.from_text('_odup', origin)):
+            obj.add_policy(name, policy)
         obj.add_default_policy()
-        obj.populate_empty_non_terminals()
         return obj
 
     @classmethod
     def from_aggregate_file(cls, origin, filename):
         policy_realms = {}
 
-        z = dns.zone.from_file(filename, dns.name.from_text('_odup', origin))
-
-        for name, ttl, rdata in z.iterate_rdatas():
+        for name, policy in _iterate_master_file(filename, dns.name.from_text('_odup', origin)):
+            # the apex of the aggregate zone belongs to no realm
+            if name == dns.name.empty:
+                continue
             suffix = dns.name.Name(name[-1:]).derelativize(origin)
             name = dns.name.Name(name[:-1])
             if suffix not in policy_realms:
                 policy_realms[suffix] = ODUPPolicyRealm(suffix)
-            policy_realms[suffix].add_policy_from_rdata(name, rdata)
+            policy_realms[suffix].add_policy(name, policy)
 
         for suffix in policy_realms:
             policy_realms[suffix].add_default_policy()
-            policy_realms[suffix].populate_empty_non_terminals()
         return policy_realms
 
     def __repr__(self):
         return '<%s: %s>' % (self.__class__.__name__, self.origin.to_text())
 
+    def memory_footprint(self, seen=None):
+        # Return the approximate number of bytes used by this realm.  Objects
+        # whose ids are already in seen are not counted; passing the same set
+        # for several realms counts the labels and policies they share only
+        # once.
+        if seen is None:
+            seen = set()
+        total = _sizeof(self, seen) + _sizeof(self.origin, seen) + \
+                _sizeof(self.origin.labels, seen)
+        for label in self.origin.labels:
+            total += _sizeof(label, seen)
+
+        nodes = [self._root]
+        while nodes:
+            node = nodes.pop()
+            total += _sizeof(node, seen) + _sizeof(node.policy, seen)
+            if node.children is not None:
+                total += _sizeof(node.children, seen)
+                for label, child in node.children.iteritems():
+                    total += _sizeof(label, seen)
+                    nodes.append(child)
+        return total
+
     def populate_empty_non_terminals(self):
-        for name in self._policies.keys():
-            if name in (dns.name.empty, dns.name.root):
-                continue
+        # Kept for compatibility; empty non-terminals are now created along
+        # with the names below them.
+        pass
 
-            name = name.parent()
-            while name not in self._policies:
-                self._policies[name] = None
-                try:
-                    name = name.parent()
-                except dns.name.NoParent:
-                    break
+    def _add_name(self, name):
+        node = self._root
+        for label in reversed(name.labels):
+            node = node.add_child(label)
+        return node
+
+    def add_policy(self, name, policy):
+        # Mark that the name exists, and if policy is not None, that it has
+        # that policy.  Policies are drawn from a small set of distinct
+        # values, so share a single copy of each.
+        node = self._add_name(name)
+        if policy is not None:
+            node.policy = intern(policy)
 
     def add_policy_from_rdata(self, name, rdata):
         # If not type TXT, then mark that the name merely exists, but with
         # no policy
         if not isinstance(rdata, dns.rdtypes.ANY.TXT.TXT):
-            self._policies[name] = None
+            self.add_policy(name, None)
             return
 
         rdata_txt = rdata.to_text().strip('"')
         # If not an ODUP policy, then mark that the name merely exists, but
         # with no policy
         if ODUP_VERS1.search(rdata_txt) is None:
-            self._policies[name] = None
+            self.add_policy(name, None)
             return
 
-        self._policies[name] = rdata_txt
+        self.add_policy(name, rdata_txt)
 
     def add_default_policy(self):
         # add a default policy for the origin, if there isn't one already
-        if self._policies.get(dns.name.empty, None) is None:
-            self._policies[dns.name.empty] = ''
+        if self._root.policy is None:
+            self._root.policy = ''
 
     def resolve(self, name, response):
         assert not name.is_absolute() or name.is_subdomain(self.origin)
@@ -133,25 +373,34 @@ class ODUPPolicyRealm(object):
         longest_match = None
         longest_match_boundary = None
         existing_labels = 0
+        node = None
         for i in range(len(name) + 1):
 
             if i == 0:
                 test_domain = dns.name.empty
-                wildcard_name = None
+                node = self._root
+                wildcard_node = None
             else:
                 test_domain = dns.name.Name(name[-i:])
-                wildcard_name = dns.name.from_text('*', test_domain.parent())
+                parent = node
+                if parent is None:
+                    # the parent only matched a wildcard
+                    node = None
+                    wildcard_node = None
+                else:
+                    node = parent.get_child(name[-i])
+                    wildcard_node = parent.get_child('*')
 
             test_domain_qualified = dns.name.Name(test_domain.labels + ('_odup',) + self.origin.labels)
 
             policy = None
             # Name exists; check for policy
-            if test_domain in self._policies:
+            if node is not None:
                 if i > 0:
                     existing_labels += 1
-                if self._policies[test_domain] is not None:
-                    _logger.debug('%s/TXT: NOERROR (local): %s' % (test_domain_qualified, self._policies[test_domain]))
-                    policy = self._policies[test_domain]
+                if node.policy is not None:
+                    _logger.debug('%s/TXT: NOERROR (local): %s' % (test_domain_qualified, node.policy))
+                    policy = node.policy
                     response.add_query(test_domain_qualified, dns.rcode.NOERROR, policy)
                 else:
                     # It's effectively a NODATA response
@@ -160,10 +409,10 @@ class ODUPPolicyRealm(object):
                     pass
 
             # Name doesn't exist; check for wildcard
-            elif wildcard_name in self._policies and self._policies[wildcard_name] is not None:
-                _logger.debug('%s/TXT: NOERROR (wildcard local): %s' % (test_domain_qualified, self._policies[wildcard_name]))
+            elif wildcard_node is not None and wildcard_node.policy is not None:
+                _logger.debug('%s/TXT: NOERROR (wildcard local): %s' % (test_domain_qualified, wildcard_node.policy))
                 existing_labels += 1
-                policy = self._policies[wildcard_name]
+                policy = wildcard_node.policy
                 response.add_query(test_domain_qualified, dns.rcode.NOERROR, policy)
 
             # Effective NXDOMAIN:
@@ -249,14 +498,1008 @@ class ODUPResponse(object):
         self.org_domain = org_domain
         self.policy = policy
 
+class _TCPConnection(object):
+    # A persistent TCP connection to a single upstream server.  Any number of
+    # queries may be outstanding on the connection at once; responses are
+    # matched to their queries by message ID, so they may arrive in any order.
+    # Whichever waiting thread first finds no reader active becomes the
+    # reader, and stashes responses belonging to other threads until they
+    # collect them.
+
+    def __init__(self, address, port, timeout):
+        af = dns.inet.af_for_address(address)
+        self._sock = socket.socket(af, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock.settimeout(timeout)
+        try:
+            self._sock.connect((address, port))
+        except:
+            self._sock.close()
+            raise
+        self._send_lock = threading.Lock()
+        self._cv = threading.Condition(threading.Lock())
+        self._reading = False
+        self._pending = set()
+        self._responses = {}
+        self._partial = False
+        self.closed = False
+
+    def close(self):
+        with self._cv:
+            self.closed = True
+            self._cv.notify_all()
+        self._sock.close()
+
+    def send(self, query):
+        with self._cv:
+            if self.closed:
+                raise EOFError
+            while query.id in self._pending:
+                query.id = random.randint(0, 0xffff)
+            self._pending.add(query.id)
+        wire = query.to_wire()
+        try:
+            with self._send_lock:
+                self._sock.sendall(struct.pack('!H', len(wire)) + wire)
+        except:
+            self.close()
+            raise
+
+    def receive(self, msg_id, expiration):
+        try:
+            with self._cv:
+                while msg_id not in self._responses:
+                    if self.closed:
+                        raise EOFError
+                    if not self._reading:
+                        self._reading = True
+                        break
+                    timeout = expiration - time.time()
+                    if timeout <= 0:
+                        raise dns.exception.Timeout
+                    self._cv.wait(timeout)
+                else:
+                    return self._responses.pop(msg_id)
+
+            try:
+                while True:
+                    wire = self._read_message(expiration)
+                    resp_id, = struct.unpack('!H', wire[:2])
+                    if resp_id == msg_id:
+                        return wire
+                    with self._cv:
+                        if resp_id in self._pending:
+                            self._responses[resp_id] = wire
+                            self._cv.notify_all()
+            except dns.exception.Timeout:
+                # a partial read leaves the stream unusable; otherwise, the
+                # connection remains good for other outstanding queries
+                if self._partial:
+                    self.close()
+                raise
+            except:
+                self.close()
+                raise
+            finally:
+                with self._cv:
+                    self._reading = False
+                    self._cv.notify_all()
+        finally:
+            with self._cv:
+                self._pending.discard(msg_id)
+                self._responses.pop(msg_id, None)
+
+    def _read_message(self, expiration):
+        l, = struct.unpack('!H', self._read_exactly(2, expiration))
+        wire = self._read_exactly(l, expiration)
+        self._partial = False
+        if len(wire) < 2:
+            raise dns.exception.FormError('TCP message too short')
+        return wire
+
+    def _read_exactly(self, count, expiration):
+        s = ''
+        while len(s) < count:
+            timeout = expiration - time.time()
+            if timeout <= 0:
+                raise dns.exception.Timeout
+            self._sock.settimeout(timeout)
+            try:
+                n = self._sock.recv(count - len(s))
+            except socket.timeout:
+                raise dns.exception.Timeout
+            if not n:
+                raise EOFError
+            self._partial = True
+            s += n
+        return s
+
+class _UpstreamStats(object):
+    def __init__(self):
+        self.srtt = None
+        self.updated = 0.0
+        self.inflight = []
+        self.failures = 0
+        self.backoff_until = 0.0
+
+    def decayed_srtt(self, now, halflife):
+        # The SRTT of a server that goes unused decays towards zero, so that
+        # one measured as slow is eventually probed again.
+        if self.srtt is None:
+            return 0.0
+        return self.srtt * 0.5 ** (max(now - self.updated, 0.0) / halflife)
+
+    def estimate(self, now, halflife):
+        # Queries still outstanding count as samples of at least the time
+        # they have been waiting, so that a slow server is passed over
+        # before its first answer comes back.
+        srtt = self.decayed_srtt(now, halflife)
+        if self.inflight:
+            srtt = max(srtt, now - min(self.inflight))
+        return srtt
+
+    def add_sample(self, rtt, now, weight, halflife):
+        if self.srtt is None:
+            self.srtt = rtt
+        else:
+            srtt = self.decayed_srtt(now, halflife)
+            self.srtt = srtt + (rtt - srtt) * weight
+        self.updated = now
+
+class _HedgeAnswered(Exception):
+    pass
+
+class _Hedge(object):
+    # While the calling thread waits for one server, sends the query to each
+    # of the servers after it, hedge_delay seconds apart, from threads of
+    # their own.  The calling thread selects on a socket through which those
+    # threads wake it, and poll() raises _HedgeAnswered once one of them has
+    # an answer.  Nothing is started unless a hedge is actually sent.
+
+    def __init__(self, transport, nameservers, qname, rdtype, rdclass, expiration):
+        self._transport = transport
+        self._nameservers = nameservers
+        self._query = (qname, rdtype, rdclass)
+        self._expiration = expiration
+        self._results = Queue.Queue()
+        self._outstanding = 0
+        self._wakeup = None
+        self.next = 0
+        self.due = None
+        self.response = None
+        self.errors = []
+
+    def close(self):
+        if self._wakeup is not None:
+            for sock in self._wakeup:
+                sock.close()
+
+    def take(self):
+        # Return the next server, for the calling thread to query itself.
+        nameserver = self._nameservers[self.next]
+        self.next += 1
+        self.due = time.time() + self._transport.hedge_delay
+        return nameserver
+
+    def wait_fds(self):
+        if self._wakeup is None:
+            return []
+        return [self._wakeup[0]]
+
+    def wait_time(self, timeout):
+        # Return how long the calling thread may wait before calling poll().
+        if self.next >= len(self._nameservers):
+            return timeout
+        return max(min(timeout, self.due - time.time()), 0)
+
+    def poll(self):
+        # Collect the outcomes of hedged queries, and send the next one if it
+        # is due.
+        if self._wakeup is not None:
+            try:
+                self._wakeup[0].recv(4096)
+            except socket.error:
+                pass
+        while True:
+            try:
+                response, error = self._results.get_nowait()
+            except Queue.Empty:
+                break
+            self._outstanding -= 1
+            if response is not None:
+                self.response = response
+                raise _HedgeAnswered
+            self.errors.append(error)
+            # a failed hedge is replaced straight away
+            self.due = time.time()
+
+        now = time.time()
+        if self.next < len(self._nameservers) and now >= self.due and now < self._expiration:
+            self._launch(self._nameservers[self.next], self._expiration - now)
+            self.next += 1
+            self.due = now + self._transport.hedge_delay
+
+    def wait(self):
+        # Return the first answer to the hedged queries still outstanding, or
+        # None if none of them has one.
+        while self._outstanding:
+            response, error = self._results.get()
+            self._outstanding -= 1
+            if response is not None:
+                return response
+            self.errors.append(error)
+        return None
+
+    def _launch(self, nameserver, timeout):
+        qname, rdtype, rdclass = self._query
+        _logger = logging.getLogger(__name__)
+        _logger.debug('%s/%s: hedging to %s' % (qname, dns.rdatatype.to_text(rdtype), nameserver))
+        if self._wakeup is None:
+            self._wakeup = socket.socketpair()
+            self._wakeup[0].setblocking(0)
+        wakeup = self._wakeup[1]
+
+        def _worker():
+            self._results.put(self._transport._query_and_measure(nameserver, qname, rdtype, rdclass, timeout))
+            try:
+                wakeup.send('x')
+            except socket.error:
+                pass
+        self._outstanding += 1
+        t = threading.Thread(target=_worker)
+        t.daemon = True
+        t.start()
+
+class ODUPTransport(object):
+    # A drop-in replacement for the query() method of dns.resolver.Resolver,
+    # which keeps a pool of UDP sockets for reuse, advertises an EDNS buffer
+    # size large enough for typical aggregated TXT answers, and falls back to
+    # a persistent, pipelined TCP connection to each server on truncation.
+    #
+    # Reusing a UDP socket reuses its source port, leaving only the 16-bit
+    # message ID to protect against off-path spoofing.  Sockets are therefore
+    # retired after udp_socket_uses queries; setting it to 1 disables reuse
+    # altogether.
+    #
+    # Each attempt waits up to timeout seconds, and the servers are tried
+    # again until lifetime seconds have passed, as by dns.resolver.Resolver.
+    # Servers are tried in order of smoothed RTT, and servers that fail are
+    # backed off.  The SRTT of an unused server halves every srtt_halflife
+    # seconds, so that it gets probed again.  If hedge_delay is set, a server that hasn't answered
+    # within that many seconds is raced against the next one.
+
+    SRTT_WEIGHT = 0.125
+
+    def __init__(self, nameservers=None, port=53, timeout=2.0, lifetime=30.0, payload=1232, udp_pool_size=8,
+            udp_socket_uses=8, hedge_delay=None, backoff_base=1.0, backoff_max=60.0, srtt_halflife=60.0):
+        if nameservers is None:
+            nameservers = dns.resolver.Resolver().nameservers
+        self.nameservers = list(nameservers)
+        self.port = port
+        self.timeout = timeout
+        self.lifetime = lifetime
+        self.payload = payload
+        self.udp_pool_size = udp_pool_size
+        self.udp_socket_uses = udp_socket_uses
+        self.hedge_delay = hedge_delay
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.srtt_halflife = srtt_halflife
+
+        self._lock = threading.Lock()
+        self._udp_pool = {}
+        self._tcp_connections = {}
+        self._tcp_connect_locks = {}
+        self._no_edns = set()
+        self._stats = {}
+
+    def close(self):
+        with self._lock:
+            for pool in self._udp_pool.values():
+                for sock, uses in pool:
+                    sock.close()
+            self._udp_pool = {}
+            for conn in self._tcp_connections.values():
+                conn.close()
+            self._tcp_connections = {}
+
+    def query(self, qname, rdtype=dns.rdatatype.A, rdclass=dns.rdataclass.IN):
+        if isinstance(qname, basestring):
+            qname = dns.name.from_text(qname)
+        if isinstance(rdtype, basestring):
+            rdtype = dns.rdatatype.from_text(rdtype)
+        if isinstance(rdclass, basestring):
+            rdclass = dns.rdataclass.from_text(rdclass)
+
+        # As with dns.resolver.Resolver.query(), go round the servers until
+        # lifetime expires, pausing a little longer after each round in which
+        # all of them failed.  Servers that give an answer that retrying won't
+        # fix are dropped for the rest of the query.
+        expiration = time.time() + self.lifetime
+        errors = []
+        dropped = set()
+        backoff = 0.10
+        while True:
+            nameservers = [n for n in self._ordered_nameservers() if n not in dropped]
+            if not nameservers:
+                raise dns.resolver.NoNameservers(request=dns.message.make_query(qname, rdtype, rdclass), errors=errors)
+            timeout = expiration - time.time()
+            if timeout <= 0:
+                raise dns.exception.Timeout(timeout=self.lifetime)
+
+            if self.hedge_delay is None:
+                response, round_errors = self._query_sequential(nameservers, qname, rdtype, rdclass, expiration)
+            else:
+                response, round_errors = self._query_hedged(nameservers, qname, rdtype, rdclass, expiration)
+            if response is not None:
+                return self._make_answer(qname, rdtype, rdclass, response)
+
+            errors.extend(round_errors)
+            for nameserver, tcp, port, error, response in round_errors:
+                if response is not None or isinstance(error, (dns.exception.FormError, EOFError)):
+                    dropped.add(nameserver)
+
+            timeout = expiration - time.time()
+            if timeout > 0 and len(dropped) < len(self.nameservers):
+                time.sleep(min(timeout, backoff))
+                backoff = min(backoff * 2, 2.0)
+
+    def _query_sequential(self, nameservers, qname, rdtype, rdclass, expiration):
+        # Query each server in turn, returning a tuple of (response, errors).
+        errors = []
+        for nameserver in nameservers:
+            timeout = expiration - time.time()
+            if timeout <= 0:
+                break
+            response, error = self._query_and_measure(nameserver, qname, rdtype, rdclass, timeout)
+            if response is not None:
+                return response, errors
+            errors.append(error)
+        return None, errors
+
+    def _query_hedged(self, nameservers, qname, rdtype, rdclass, expiration):
+        # Query the preferred server from this thread.  If it hasn't answered
+        # within hedge_delay, query the next one as well, from a thread of its
+        # own, taking whichever answers first; if it fails, move on to the
+        # next one straight away.  Return a tuple of (response, errors).
+        hedge = _Hedge(self, nameservers, qname, rdtype, rdclass, expiration)
+        try:
+            while hedge.next < len(nameservers):
+                timeout = expiration - time.time()
+                if timeout <= 0:
+                    break
+                nameserver = hedge.take()
+                try:
+                    response, error = self._query_and_measure(nameserver, qname, rdtype, rdclass, timeout, hedge)
+                except _HedgeAnswered:
+                    return hedge.response, hedge.errors
+                if response is not None:
+                    return response, hedge.errors
+                hedge.errors.append(error)
+            # wait for any hedged queries still outstanding
+            return hedge.wait(), hedge.errors
+        finally:
+            hedge.close()
+
+    def _make_answer(self, qname, rdtype, rdclass, response):
+        if response.rcode() == dns.rcode.NXDOMAIN:
+            raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: response})
+        return dns.resolver.Answer(qname, rdtype, rdclass, response)
+
+    def _ordered_nameservers(self):
+        # Prefer servers that are not backing off, then those with the lowest
+        # estimated RTT.  Servers not yet queried sort first, so that each gets
+        # measured; ties keep the configured order.
+        now = time.time()
+        with self._lock:
+            keys = []
+            for i, nameserver in enumerate(self.nameservers):
+                stats = self._stats.get(nameserver)
+                if stats is None:
+                    keys.append((False, 0.0, i, nameserver))
+                else:
+                    keys.append((stats.backoff_until > now, stats.estimate(now, self.srtt_halflife), i, nameserver))
+        keys.sort()
+        return [k[-1] for k in keys]
+
+    def _get_stats(self, nameserver):
+        # Called with the lock held.
+        stats = self._stats.get(nameserver)
+        if stats is None:
+            stats = self._stats[nameserver] = _UpstreamStats()
+        return stats
+
+    def _record_start(self, nameserver, start):
+        with self._lock:
+            self._get_stats(nameserver).inflight.append(start)
+
+    def _record_end(self, nameserver, start):
+        with self._lock:
+            self._get_stats(nameserver).inflight.remove(start)
+
+    def _record_success(self, nameserver, rtt):
+        with self._lock:
+            stats = self._get_stats(nameserver)
+            stats.add_sample(rtt, time.time(), self.SRTT_WEIGHT, self.srtt_halflife)
+            stats.failures = 0
+            stats.backoff_until = 0.0
+
+    def _record_sample(self, nameserver, rtt):
+        with self._lock:
+            self._get_stats(nameserver).add_sample(rtt, time.time(), self.SRTT_WEIGHT, self.srtt_halflife)
+
+    def _record_failure(self, nameserver):
+        # Count the failure as a sample of the full timeout, and keep the
+        # server out of the preferred set for an exponentially increasing
+        # period.
+        with self._lock:
+            stats = self._get_stats(nameserver)
+            now = time.time()
+            stats.add_sample(self.timeout, now, self.SRTT_WEIGHT, self.srtt_halflife)
+            stats.failures += 1
+            backoff = min(self.backoff_max, self.backoff_base * 2 ** (stats.failures - 1))
+            stats.backoff_until = now + backoff
+
+    def _query_and_measure(self, nameserver, qname, rdtype, rdclass, timeout, hedge=None):
+        # Return a tuple of (response, error), exactly one of which is None.
+        # Errors are in the form expected by dns.resolver.NoNameservers.
+        start = time.time()
+        self._record_start(nameserver, start)
+        tcp = False
+        try:
+            request, response = self._query_nameserver(nameserver, qname, rdtype, rdclass, timeout, hedge)
+            if response.flags & dns.flags.TC:
+                tcp = True
+                response = self._query_tcp(request, nameserver, timeout)
+        except (socket.error, EOFError, dns.exception.DNSException), e:
+            self._record_failure(nameserver)
+            return None, (nameserver, tcp, self.port, e, None)
+        except _HedgeAnswered:
+            # another server answered first; this one took at least as long
+            self._record_sample(nameserver, time.time() - start)
+            raise
+        finally:
+            self._record_end(nameserver, start)
+
+        rcode = response.rcode()
+        if rcode not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+            self._record_failure(nameserver)
+            return None, (nameserver, tcp, self.port, dns.rcode.to_text(rcode), response)
+
+        self._record_success(nameserver, time.time() - start)
+        return response, None
+
+    def _make_query(self, nameserver, qname, rdtype, rdclass):
+        if nameserver in self._no_edns:
+            return dns.message.make_query(qname, rdtype, rdclass)
+        return dns.message.make_query(qname, rdtype, rdclass, use_edns=0, payload=self.payload)
+
+    def _query_nameserver(self, nameserver, qname, rdtype, rdclass, timeout, hedge=None):
+        # Return a tuple of (request, response) for the query sent over UDP.
+        request = self._make_query(nameserver, qname, rdtype, rdclass)
+        response = self._query_udp(request, nameserver, timeout, hedge)
+
+        # servers that don't understand EDNS respond with FORMERR; remember
+        # that and retry without it
+        if response.rcode() == dns.rcode.FORMERR and request.edns >= 0:
+            self._no_edns.add(nameserver)
+            request = self._make_query(nameserver, qname, rdtype, rdclass)
+            response = self._query_udp(request, nameserver, timeout, hedge)
+        return request, response
+
+    def _get_udp_socket(self, af):
+        # Return a tuple of (socket, number of queries already sent on it).
+        with self._lock:
+            pool = self._udp_pool.get(af)
+            if pool:
+                return pool.pop()
+        sock = socket.socket(af, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        return sock, 0
+
+    def _release_udp_socket(self, af, sock, uses):
+        # Retire sockets after udp_socket_uses queries, so that the source
+        # port keeps changing and, together with the message ID, makes
+        # answers hard to spoof.
+        if uses < self.udp_socket_uses:
+            with self._lock:
+                pool = self._udp_pool.setdefault(af, [])
+                if len(pool) < self.udp_pool_size:
+                    pool.append((sock, uses))
+                    return
+        sock.close()
+
+    def _query_udp(self, request, nameserver, timeout, hedge=None):
+        af = dns.inet.af_for_address(nameserver)
+        destination = (nameserver, self.port)
+        destination_address = dns.inet.inet_pton(af, nameserver)
+        expiration = time.time() + min(timeout, self.timeout)
+
+        sock, uses = self._get_udp_socket(af)
+        try:
+            sock.sendto(request.to_wire(), destination)
+            while True:
+                timeout = expiration - time.time()
+                if timeout <= 0:
+                    raise dns.exception.Timeout
+                if hedge is None:
+                    if not select.select([sock], [], [], timeout)[0]:
+                        raise dns.exception.Timeout
+                else:
+                    readable = select.select([sock] + hedge.wait_fds(), [], [], hedge.wait_time(timeout))[0]
+                    hedge.poll()
+                    if sock not in readable:
+                        continue
+                wire, source = sock.recvfrom(65535)
+                # A pooled socket may still receive late answers to earlier
+                # queries that timed out; discard anything that isn't a
+                # response to this one.  Addresses are compared in binary
+                # form, since the server may be given in a non-canonical one.
+                try:
+                    if source[1] != self.port or dns.inet.inet_pton(af, source[0]) != destination_address:
+                        continue
+                except (socket.error, ValueError):
+                    continue
+                try:
+                    response = dns.message.from_wire(wire, keyring=request.keyring,
+                            request_mac=request.mac, one_rr_per_rrset=False)
+                except dns.exception.DNSException:
+                    continue
+                if request.is_response(response):
+                    break
+        except:
+            sock.close()
+            raise
+        self._release_udp_socket(af, sock, uses + 1)
+        return response
+
+    def _get_tcp_connection(self, nameserver, timeout):
+        # Connections to each server are set up one at a time, so that when
+        # several truncated answers arrive at once, the threads retrying them
+        # share a single new connection.
+        with self._lock:
+            connect_lock = self._tcp_connect_locks.get(nameserver)
+            if connect_lock is None:
+                connect_lock = self._tcp_connect_locks[nameserver] = threading.Lock()
+        with connect_lock:
+            with self._lock:
+                conn = self._tcp_connections.get(nameserver)
+                if conn is not None and not conn.closed:
+                    return conn
+            conn = _TCPConnection(nameserver, self.port, timeout)
+            with self._lock:
+                self._tcp_connections[nameserver] = conn
+            return conn
+
+    def _query_tcp(self, request, nameserver, timeout):
+        # A cached connection may have been closed by the server since it was
+        # last used, so retry once on a fresh one.
+        expiration = time.time() + min(timeout, self.timeout)
+        for attempt in (0, 1):
+            conn = self._get_tcp_connection(nameserver, expiration - time.time())
+            try:
+                conn.send(request)
+                wire = conn.receive(request.id, expiration)
+            except (socket.error, EOFError):
+                if attempt or not conn.closed:
+                    raise
+                continue
+            response = dns.message.from_wire(wire, keyring=request.keyring,
+                    request_mac=request.mac, one_rr_per_rrset=False)
+            if not request.is_response(response):
+                raise dns.query.BadResponse
+            return response
+
+class ODUPAnswerCache(object):
+    # A persistent cache of the outcomes of _odup TXT queries, backed by an
+    # sqlite database so that it survives restarts and may be shared by
+    # several processes.  Unexpired entries are loaded into memory when the
+    # cache is opened, lookups are served from memory only, and new entries
+    # are written to the database by a background thread.  Both the
+    # in-memory and the on-disk copies are held to max_entries, evicting
+    # expired entries first and then those closest to expiring.
+
+    NOERROR = 'NOERROR'
+    NXDOMAIN = 'NXDOMAIN'
+    NODATA = 'NODATA'
+
+    # how long to wait before trying again to open a database that couldn't
+    # be opened for writing
+    REOPEN_INTERVAL = 10.0
+
+    def __init__(self, filename, max_entries=100000):
+        self.filename = filename
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._closed = False
+        self._entries = {}
+        self._load()
+
+        self._queue = Queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop)
+        self._writer.daemon = True
+        self._writer.start()
+
+    def _connect(self):
+        # WAL mode lets readers in other processes proceed while this one
+        # writes
+        conn = sqlite3.connect(self.filename, timeout=30.0)
+        conn.text_factory = str
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS odup_answers '
+                '(name TEXT PRIMARY KEY, result TEXT NOT NULL, policy TEXT, expiration REAL NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS odup_answers_expiration ON odup_answers (expiration)')
+        conn.commit()
+        return conn
+
+    def _load(self):
+        conn = self._connect()
+        try:
+            rows = conn.execute('SELECT name, result, policy, expiration FROM odup_answers '
+                    'WHERE expiration > ? ORDER BY expiration DESC LIMIT ?', (time.time(), self.max_entries))
+            for name, result, policy, expiration in rows:
+                if policy is not None:
+                    policy = intern(policy)
+                self._entries[dns.name.from_text(name)] = (result, policy, expiration)
+        finally:
+            conn.close()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, name):
+        # Return a tuple of (result, policy) for name, or None if there is no
+        # unexpired entry for it.
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        result, policy, expiration = entry
+        if expiration <= time.time():
+            with self._lock:
+                if self._entries.get(name) is entry:
+                    del self._entries[name]
+            return None
+        return result, policy
+
+    def put(self, name, result, policy, expiration):
+        # Once the cache is closed, there is no writer, so nothing more is
+        # added.
+        if policy is not None:
+            policy = intern(policy)
+        with self._lock:
+            if self._closed:
+                return
+            self._entries[name] = (result, policy, expiration)
+            if len(self._entries) > self.max_entries:
+                self._evict()
+            self._queue.put((name.canonicalize().to_text(), result, policy, expiration))
+
+    def put_negative(self, name, result, response):
+        # Negative answers are cached for the lesser of the TTL and minimum
+        # field of the SOA in the authority section (RFC 2308); without one,
+        # they are not cached at all.
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                ttl = min(rrset.ttl, rrset[0].minimum)
+                self.put(name, result, None, time.time() + ttl)
+                return
+
+    def _evict(self):
+        # Called with the lock held.  Remove expired entries, and if that
+        # isn't enough, a tenth of the rest, soonest-expiring first.
+        now = time.time()
+        for name, entry in self._entries.items():
+            if entry[2] <= now:
+                del self._entries[name]
+        excess = len(self._entries) - self.max_entries
+        if excess > 0:
+            excess = max(excess, self.max_entries // 10)
+            for name, entry in heapq.nsmallest(excess, self._entries.iteritems(), key=lambda x: x[1][2]):
+                del self._entries[name]
+
+    def flush(self):
+        # Block until all pending entries have been written to disk.
+        self._queue.join()
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._writer.join()
+
+    def _open_for_writing(self):
+        # Return a tuple of (connection, upper bound on the number of rows),
+        # or (None, None) if the database can't be opened.  The bound is kept
+        # so that the table needn't be counted on every write.
+        conn = None
+        try:
+            conn = self._connect()
+            row_count, = conn.execute('SELECT COUNT(*) FROM odup_answers').fetchone()
+            return conn, row_count
+        except Exception:
+            _logger = logging.getLogger(__name__)
+            _logger.exception('%s: cache unavailable for writing' % (self.filename))
+            if conn is not None:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            return None, None
+
+    def _write_loop(self):
+        _logger = logging.getLogger(__name__)
+
+        conn, row_count = self._open_for_writing()
+        reopen_time = time.time() + self.REOPEN_INTERVAL
+        try:
+            while True:
+                rows = [self._queue.get()]
+                # write whatever else has been queued in the same transaction
+                while True:
+                    try:
+                        rows.append(self._queue.get_nowait())
+                    except Queue.Empty:
+                        break
+                stop = None in rows
+                rows_to_write = [row for row in rows if row is not None]
+                try:
+                    if conn is None and rows_to_write and time.time() >= reopen_time:
+                        conn, row_count = self._open_for_writing()
+                        reopen_time = time.time() + self.REOPEN_INTERVAL
+                    if conn is not None and rows_to_write:
+                        conn.executemany('INSERT OR REPLACE INTO odup_answers VALUES (?, ?, ?, ?)', rows_to_write)
+                        row_count += len(rows_to_write)
+                        if row_count > self.max_entries:
+                            row_count -= conn.execute('DELETE FROM odup_answers WHERE expiration <= ?', (time.time(),)).rowcount
+                        if row_count > self.max_entries:
+                            row_count, = conn.execute('SELECT COUNT(*) FROM odup_answers').fetchone()
+                        if row_count > self.max_entries:
+                            conn.execute('DELETE FROM odup_answers WHERE name IN '
+                                    '(SELECT name FROM odup_answers ORDER BY expiration DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+                            row_count = self.max_entries
+                        conn.commit()
+                except Exception, e:
+                    # keep the writer alive, so that flush() doesn't block
+                    # forever
+                    if isinstance(e, sqlite3.Error):
+                        _logger.error('%s: cache write failed: %s' % (self.filename, e))
+                    else:
+                        _logger.exception('%s: cache write failed' % (self.filename))
+                    if conn is not None:
+                        try:
+                            conn.rollback()
+                        except sqlite3.Error:
+                            pass
+                finally:
+                    for row in rows:
+                        self._queue.task_done()
+                if stop:
+                    break
+        finally:
+            if conn is not None:
+                conn.close()
+
+def _policy_from_answer(ans):
+    try:
+        return filter(lambda x: ODUP_VERS1.search(x.to_text().strip('"')), ans.rrset)[0].to_text().strip('"')
+    except IndexError:
+        return None
+
+class _InflightQuery(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.answer = None
+        self.error = None
+
 class ODUPResolver(object):
-    def __init__(self, resolver=None, local_policies=None):
+    # An ODUPResolver may be shared among threads; concurrent lookups of the
+    # same _odup name are coalesced into a single upstream query.
+    #
+    # If localize_threshold is set, a realm whose policy carries +fetch is
+    # transferred in the background once that many of its names have been
+    # looked up, and is thereafter resolved from local_policies, refreshed
+    # according to the timers in its SOA.  A realm that can't be transferred
+    # isn't tried again for a period that doubles with each failure.
+
+    # the longest a realm transfer may take
+    XFR_LIFETIME = 300.0
+    LOCALIZE_BACKOFF_BASE = 60.0
+    LOCALIZE_BACKOFF_MAX = 86400.0
+
+    def __init__(self, resolver=None, local_policies=None, localize_threshold=None, cache=None):
         if resolver is None:
             resolver = dns.resolver.Resolver()
         self._resolver = resolver
         if local_policies is None:
             local_policies = {}
         self._local_policies = local_policies
+        if localize_threshold is not None and localize_threshold < 1:
+            raise ValueError('localize_threshold must be at least 1')
+        self.localize_threshold = localize_threshold
+        self._cache = cache
+
+        self._inflight_lock = threading.Lock()
+        self._inflight = {}
+
+        self._localize_lock = threading.Lock()
+        self._fetch_counts = {}
+        self._localizing = set()
+        # origin -> (SOA, expiration time) of realms localized by us
+        self._localized = {}
+        # origin -> (consecutive failures, time before which no transfer is
+        # attempted) of realms that couldn't be localized
+        self._localize_failures = {}
+
+    def _query(self, qname, rdtype):
+        # Coalesce concurrent identical queries, so that only one is
+        # outstanding upstream and every caller shares its outcome.
+        key = (qname, rdtype)
+        with self._inflight_lock:
+            inflight = self._inflight.get(key)
+            leader = inflight is None
+            if leader:
+                inflight = self._inflight[key] = _InflightQuery()
+
+        if leader:
+            try:
+                inflight.answer = self._query_upstream(qname, rdtype)
+            except BaseException, e:
+                # whatever ends the query, the waiters must not mistake it
+                # for an answer
+                inflight.error = e
+                raise
+            finally:
+                with self._inflight_lock:
+                    del self._inflight[key]
+                inflight.event.set()
+            return inflight.answer
+
+        inflight.event.wait()
+        if inflight.error is not None:
+            raise inflight.error
+        return inflight.answer
+
+    def _query_upstream(self, qname, rdtype):
+        # Send the query upstream and record its outcome in the answer cache.
+        # Only the thread leading a coalesced query calls this, so that each
+        # upstream answer is written to the cache once.
+        try:
+            ans = self._resolver.query(qname, rdtype)
+        except dns.resolver.NXDOMAIN, e:
+            if self._cache is not None:
+                for r in e.kwargs.get('responses', {}).values():
+                    self._cache.put_negative(qname, ODUPAnswerCache.NXDOMAIN, r)
+            raise
+        except dns.resolver.NoAnswer, e:
+            if self._cache is not None and e.kwargs.get('response') is not None:
+                self._cache.put_negative(qname, ODUPAnswerCache.NODATA, e.kwargs['response'])
+            raise
+
+        if self._cache is not None and rdtype == dns.rdatatype.TXT:
+            self._cache.put(qname, ODUPAnswerCache.NOERROR, _policy_from_answer(ans), ans.expiration)
+        return ans
+
+    def _query_policy(self, qname):
+        # Return the ODUP policy at qname, or None if qname has TXT records
+        # but no policy.  NXDOMAIN and NODATA are raised as exceptions, as by
+        # dns.resolver, whether learned upstream or from the answer cache.
+        if self._cache is not None:
+            cached = self._cache.get(qname)
+            if cached is not None:
+                result, policy = cached
+                if result == ODUPAnswerCache.NXDOMAIN:
+                    raise dns.resolver.NXDOMAIN
+                if result == ODUPAnswerCache.NODATA:
+                    raise dns.resolver.NoAnswer
+                return policy
+
+        return _policy_from_answer(self._query(qname, dns.rdatatype.TXT))
+
+    def _note_fetchable(self, origin):
+        with self._localize_lock:
+            if origin in self._localizing or origin in self._local_policies:
+                return
+            failure = self._localize_failures.get(origin)
+            if failure is not None and time.time() < failure[1]:
+                return
+            count = self._fetch_counts.get(origin, 0) + 1
+            if count < self.localize_threshold:
+                self._fetch_counts[origin] = count
+                return
+            self._fetch_counts.pop(origin, None)
+            self._localizing.add(origin)
+        self._schedule_localize(origin, 0)
+
+    def _schedule_localize(self, origin, delay):
+        t = threading.Timer(delay, self._localize, args=(origin,))
+        t.daemon = True
+        t.start()
+
+    def _localize(self, origin):
+        _logger = logging.getLogger(__name__)
+
+        odup_name = dns.name.Name(('_odup',) + origin.labels)
+        localized = self._localized.get(origin)
+        try:
+            # skip the transfer if the realm hasn't changed since last time
+            if localized is not None:
+                ans = self._resolver.query(odup_name, dns.rdatatype.SOA)
+                if ans.rrset[0].serial == localized[0].serial:
+                    self._finish_localize(origin, ans.rrset[0], realm=None)
+                    return
+
+            # bound the transfer, so that a stalled one can't keep the realm
+            # from being refreshed or expired
+            xfr = odup2psl.get_odup_zone(odup_name, self._resolver,
+                    timeout=self._resolver.timeout, lifetime=self.XFR_LIFETIME)
+            if xfr is None:
+                # the realm is no longer fetchable
+                _logger.info('%s: realm no longer available for transfer' % (odup_name))
+                self._unlocalize(origin)
+                return
+
+            realm = ODUPPolicyRealm(origin)
+            soa = None
+            for msg in xfr:
+                for rrset in msg.answer:
+                    if rrset.rdtype == dns.rdatatype.SOA and rrset.name == dns.name.empty:
+                        soa = rrset[0]
+                    for rdata in rrset:
+                        realm.add_policy_from_rdata(rrset.name, rdata)
+            if soa is None:
+                raise dns.exception.FormError('no SOA in transfer of %s' % (odup_name))
+            realm.add_default_policy()
+
+        except (socket.error, EOFError, dns.exception.DNSException), e:
+            _logger.warning('%s: realm transfer failed: %s' % (odup_name, e.__class__.__name__))
+            self._localize_failed(origin, localized)
+            return
+        except Exception:
+            # anything else would otherwise end the timer thread silently
+            # and leave the realm stuck in _localizing
+            _logger.exception('%s: realm transfer failed' % (odup_name))
+            self._localize_failed(origin, localized)
+            return
+
+        _logger.info('%s: localized realm (serial %d; %d bytes)' % (odup_name, soa.serial, realm.memory_footprint()))
+        self._finish_localize(origin, soa, realm)
+
+    def _localize_failed(self, origin, localized):
+        if localized is None:
+            # never localized; back off before it may be noted again
+            self._unlocalize(origin)
+            return
+        soa, expiration = localized
+        if time.time() >= expiration:
+            _logger = logging.getLogger(__name__)
+            _logger.info('%s: local copy of realm expired' % (dns.name.Name(('_odup',) + origin.labels)))
+            self._unlocalize(origin)
+            return
+        self._schedule_localize(origin, min(soa.retry, expiration - time.time()))
+
+    def _finish_localize(self, origin, soa, realm):
+        with self._localize_lock:
+            self._localized[origin] = (soa, time.time() + soa.expire)
+            if realm is not None:
+                self._local_policies[origin] = realm
+            self._localize_failures.pop(origin, None)
+        self._schedule_localize(origin, soa.refresh)
+
+    def _unlocalize(self, origin):
+        # Drop the local copy of the realm, if any, and hold off on
+        # transferring it again, so that a realm refusing transfers isn't
+        # asked again for every few lookups.
+        with self._localize_lock:
+            if origin in self._localized:
+                del self._localized[origin]
+                self._local_policies.pop(origin, None)
+            self._localizing.discard(origin)
+            failures = self._localize_failures.get(origin, (0, None))[0] + 1
+            backoff = min(self.LOCALIZE_BACKOFF_MAX, self.LOCALIZE_BACKOFF_BASE * 2 ** (failures - 1))
+            self._localize_failures[origin] = (failures, time.time() + backoff)
 
     def resolve(self, name):
         return self._resolve(name, 1, ODUPResponse())
@@ -269,9 +1512,11 @@ class ODUPResolver(object):
         _logger = logging.getLogger(__name__)
         #_logger.debug('Enter ODUPResolver._resolve(): name: %s; orgDomain: %s' % (name, org_domain))
 
-        # Check local policies
-        if org_domain in self._local_policies:
-            self._local_policies[org_domain].resolve(name, response)
+        # Check local policies.  Realms may be added or removed by the
+        # localization thread, so look up the realm only once.
+        realm = self._local_policies.get(org_domain)
+        if realm is not None:
+            realm.resolve(name, response)
             # if an policy was actually returned, then return it
             if response.policy_domain is not None:
                 return response
@@ -290,7 +1535,7 @@ class ODUPResolver(object):
             test_domain = dns.name.Name(subdomain.labels + ('_odup',) + org_domain.labels)
 
             try:
-                ans = self._resolver.query(test_domain, dns.rdatatype.TXT)
+                policy = self._query_policy(test_domain)
             except dns.resolver.NXDOMAIN:
                 # An NXDOMAIN result means that no further lookups are
                 # necessary, as there is no subtree
@@ -311,15 +1556,17 @@ class ODUPResolver(object):
             else:
                 if i > 0:
                     existing_labels += 1
-                try:
-                    policy = filter(lambda x: ODUP_VERS1.search(x.to_text().strip('"')), ans.rrset)[0].to_text().strip('"')
-                except IndexError:
+                if policy is None:
                     _logger.debug('%s/TXT: NOERROR (no policy)' % (test_domain))
                     response.add_query(test_domain, dns.rcode.NOERROR, None)
                 else:
                     _logger.debug('%s/TXT: NOERROR: %s' % (test_domain, policy))
                     response.add_query(test_domain, dns.rcode.NOERROR, policy)
 
+                    if i == 0 and self.localize_threshold is not None and \
+                            FETCH_RE.search(policy) is not None:
+                        self._note_fetchable(org_domain)
+
                     org_match = ORG_RE.search(policy)
                     bound_match = BOUND_RE.search(policy)
 
@@ -371,7 +1618,7 @@ class ODUPResolver(object):
 
 def usage():
     import sys
-    sys.stderr.write('Usage: %s [-d] [-n <domain>:<policy_file>] [-s <server>] [-p <port>] <domainname>\n' % (sys.argv[0]))
+    sys.stderr.write('Usage: %s [-d] [-n <domain>:<policy_file>] [-c <cache_file>] [-s <server>]... [-p <port>] [-b <edns_bufsize>] [-H <hedge_ms>] <domainname>\n' % (sys.argv[0]))
 
 def main():
     import sys
@@ -379,7 +1626,7 @@ def main():
     import os.path
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'n:s:p:d')
+        opts, args = getopt.getopt(sys.argv[1:], 'n:s:p:b:H:c:d')
     except getopt.error:
         usage()
         sys.exit(1)
@@ -391,7 +1638,9 @@ def main():
     _logger = logging.getLogger(__name__)
     _logger.addHandler(logging.StreamHandler())
     _logger.setLevel(logging.WARNING)
-    r = dns.resolver.Resolver()
+    r = ODUPTransport()
+    cache = None
+    nameservers = []
     local_policies = {}
     for opt, arg in opts:
         if opt == '-p':
@@ -400,8 +1649,20 @@ def main():
             except ValueError:
                 usage()
                 sys.exit(1)
+        elif opt == '-b':
+            try:
+                r.payload = int(arg)
+            except ValueError:
+                usage()
+                sys.exit(1)
         elif opt == '-s':
-            r.nameservers = [arg]
+            nameservers.append(arg)
+        elif opt == '-H':
+            try:
+                r.hedge_delay = int(arg) / 1000.0
+            except ValueError:
+                usage()
+                sys.exit(1)
         elif opt == '-n':
             try:
                 d, f = arg.split(':')
@@ -414,11 +1675,23 @@ def main():
                     local_policies.update(ODUPPolicyRealm.from_aggregate_file(n, os.path.expanduser(f)))
                 else:
                     local_policies[n] = ODUPPolicyRealm.from_file(n, os.path.expanduser(f))
+        elif opt == '-c':
+            cache = ODUPAnswerCache(os.path.expanduser(arg))
         elif opt == '-d':
             _logger.setLevel(logging.DEBUG)
 
-    r = ODUPResolver(resolver=r, local_policies=local_policies)
+    if nameservers:
+        r.nameservers = nameservers
+
+    if local_policies:
+        seen = set()
+        _logger.debug('Local policies: %d realm(s), %d bytes' % \
+                (len(local_policies), sum([p.memory_footprint(seen) for p in local_policies.values()])))
+
+    r = ODUPResolver(resolver=r, local_policies=local_policies, cache=cache)
     response = r.resolve(dns.name.from_text(args[0]))
+    if cache is not None:
+        cache.close()
     print '          Domain name: %s' % (args[0])
     print 'Organizational domain: %s' % (response.org_domain)
     print '        Policy domain: %s' % (response.policy_domain)
@@ -78,7 +78,7 @@ def import_new_tlds(f, n, n2):
             if len(name) == 2 and name not in n:
                 n2.add(name)
 
-def get_odup_zone(odup_name, resolver):
+def get_odup_zone(odup_name, resolver, timeout=None, lifetime=None):
     try:
         ans = resolver.query(odup_name, dns.rdatatype.TXT)
     except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer, dns.exception.DNSException):
@@ -96,7 +96,7 @@ def get_odup_zone(odup_name, resolver):
     uri = urlparse.urlparse(fetch_match.group('uri'))
     if uri.scheme == 'axfr':
         if uri.hostname:
-            server_name = dns.name.from_text(url.hostname)
+            server_name = dns.name.from_text(uri.hostname)
         else:
             try:
                 ans = resolver.query(odup_name, dns.rdatatype.NS)
@@ -112,7 +112,7 @@ def get_odup_zone(odup_name, resolver):
         else:
             server = addrinfo[0][4][0]
 
-        return dns.query.xfr(server, odup_name)
+        return dns.query.xfr(server, odup_name, timeout=timeout, lifetime=lifetime)
 
     else:
         #TODO
@@ -0,0 +1,800 @@
+#!/usr/bin/env python
+
+#
+# Copyright (c) 2015-2016, VeriSign, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+# 
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+# 
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import shutil
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+import dns.exception, dns.flags, dns.message, dns.name, dns.rcode, dns.rdataclass, dns.rdatatype, \
+        dns.resolver, dns.rrset, dns.zone
+
+import odup
+import odup2psl
+
+PORT = 53535
+
+class StandInServer(object):
+    # A UDP server answering every query with a single ODUP policy, after
+    # an injected delay.  The first drop queries go unanswered, and if
+    # truncate is set, answers are empty with TC set.  If edns_formerr is
+    # set, queries with EDNS get FORMERR.  If tcp_batch is set, the server
+    # also listens on TCP, answering queries on a connection in batches of
+    # that many, in reverse order.
+
+    def __init__(self, address, delay=0.0, rcode=dns.rcode.NOERROR, drop=0, truncate=False,
+            edns_formerr=False, tcp_batch=None):
+        self.delay = delay
+        self.rcode = rcode
+        self.drop = drop
+        self.truncate = truncate
+        self.edns_formerr = edns_formerr
+        self.tcp_batch = tcp_batch
+        self.queries = 0
+        self.sources = []
+        self.connections = 0
+        self._closed = False
+        self._threads = []
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.settimeout(0.05)
+        self._sock.bind((address, PORT))
+        self._start(self._serve)
+        self._tcp_sock = None
+        if tcp_batch is not None:
+            self._tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self._tcp_sock.settimeout(0.05)
+            self._tcp_sock.bind((address, PORT))
+            self._tcp_sock.listen(8)
+            self._start(self._serve_tcp)
+
+    def _start(self, target):
+        t = threading.Thread(target=target)
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def close(self):
+        self._closed = True
+        for t in self._threads:
+            t.join()
+        self._sock.close()
+        if self._tcp_sock is not None:
+            self._tcp_sock.close()
+
+    def _serve(self):
+        while not self._closed:
+            try:
+                wire, source = self._sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            self.queries += 1
+            self.sources.append(source)
+            if self.queries <= self.drop:
+                continue
+            t = threading.Timer(self.delay, self._answer, args=(wire, source))
+            t.daemon = True
+            t.start()
+
+    def _response(self, wire, tcp):
+        query = dns.message.from_wire(wire)
+        response = dns.message.make_response(query)
+        if self.edns_formerr and query.edns >= 0:
+            response.set_rcode(dns.rcode.FORMERR)
+            return response.to_wire()
+        response.set_rcode(self.rcode)
+        if self.truncate and not tcp:
+            response.flags |= dns.flags.TC
+        elif self.rcode == dns.rcode.NOERROR:
+            response.answer.append(dns.rrset.from_text(query.question[0].name, 300, 'IN', 'TXT', '"v=odup1 +org"'))
+        return response.to_wire()
+
+    def _answer(self, wire, source):
+        try:
+            self._sock.sendto(self._response(wire, False), source)
+        except socket.error:
+            pass
+
+    def _serve_tcp(self):
+        while not self._closed:
+            try:
+                conn, source = self._tcp_sock.accept()
+            except socket.timeout:
+                continue
+            self.connections += 1
+            t = threading.Thread(target=self._serve_tcp_connection, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _serve_tcp_connection(self, conn):
+        conn.settimeout(5.0)
+        queries = []
+        try:
+            while True:
+                l, = struct.unpack('!H', self._recv(conn, 2))
+                queries.append(self._recv(conn, l))
+                if len(queries) == self.tcp_batch:
+                    for wire in reversed(queries):
+                        response = self._response(wire, True)
+                        conn.sendall(struct.pack('!H', len(response)) + response)
+                    queries = []
+        except (socket.error, EOFError):
+            pass
+        finally:
+            conn.close()
+
+    def _recv(self, conn, count):
+        s = ''
+        while len(s) < count:
+            n = conn.recv(count - len(s))
+            if not n:
+                raise EOFError
+            s += n
+        return s
+
+class StandInServerTestCase(unittest.TestCase):
+    qname = dns.name.from_text('_odup.example.com')
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def _server(self, address, *args, **kwargs):
+        server = StandInServer(address, *args, **kwargs)
+        self.servers.append(server)
+        return server
+
+    def _timed_query(self, transport):
+        start = time.time()
+        transport.query(self.qname, 'TXT')
+        return time.time() - start
+
+class ODUPTransportTestCase(StandInServerTestCase):
+    def test_udp_socket_reuse(self):
+        server = self._server('127.0.0.1')
+        transport = odup.ODUPTransport(['127.0.0.1'], port=PORT, udp_socket_uses=3)
+
+        for i in range(6):
+            self._timed_query(transport)
+        ports = [source[1] for source in server.sources]
+        self.assertEqual(len(set(ports[:3])), 1)
+        self.assertEqual(len(set(ports[3:])), 1)
+        self.assertNotEqual(ports[0], ports[3])
+
+    def test_formerr_fallback(self):
+        server = self._server('127.0.0.1', edns_formerr=True)
+        transport = odup.ODUPTransport(['127.0.0.1'], port=PORT)
+
+        self._timed_query(transport)
+        self.assertEqual(server.queries, 2)
+        self.assertIn('127.0.0.1', transport._no_edns)
+        # the server is remembered not to understand EDNS
+        self._timed_query(transport)
+        self.assertEqual(server.queries, 3)
+
+    def test_tcp_pipelining(self):
+        server = self._server('127.0.0.1', truncate=True, tcp_batch=4)
+        transport = odup.ODUPTransport(['127.0.0.1'], port=PORT)
+
+        # the server only answers once all four queries have arrived on a
+        # connection, and then in reverse order
+        self._query_concurrently(transport, 4)
+        self.assertEqual(server.connections, 1)
+
+    def test_tcp_connection_shared(self):
+        # connections that take a while to set up are still shared
+        server = self._server('127.0.0.1', truncate=True, tcp_batch=1)
+        transport = odup.ODUPTransport(['127.0.0.1'], port=PORT)
+        tcp_connection = odup._TCPConnection
+        class SlowTCPConnection(tcp_connection):
+            def __init__(self, *args):
+                time.sleep(0.1)
+                tcp_connection.__init__(self, *args)
+        odup._TCPConnection = SlowTCPConnection
+        try:
+            self._query_concurrently(transport, 4)
+        finally:
+            odup._TCPConnection = tcp_connection
+        self.assertEqual(server.connections, 1)
+
+    def _query_concurrently(self, transport, count):
+        answers = {}
+        def _query(qname):
+            answers[qname] = transport.query(qname, 'TXT')
+        qnames = [dns.name.from_text('%d._odup.example.com' % (i)) for i in range(count)]
+        threads = [threading.Thread(target=_query, args=(qname,)) for qname in qnames]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(answers), sorted(qnames))
+        for qname, ans in answers.items():
+            self.assertEqual(ans.rrset.name, qname)
+
+class ODUPTransportRetryTestCase(StandInServerTestCase):
+    def test_retry_lost_query(self):
+        server = self._server('127.0.0.1', drop=1)
+        transport = odup.ODUPTransport(['127.0.0.1'], port=PORT, timeout=0.2)
+
+        ans = transport.query(self.qname, 'TXT')
+        self.assertEqual(ans.rrset[0].to_text(), '"v=odup1 +org"')
+        self.assertEqual(server.queries, 2)
+
+    def test_lifetime(self):
+        server = self._server('127.0.0.1', drop=1000)
+        transport = odup.ODUPTransport(['127.0.0.1'], port=PORT, timeout=0.1, lifetime=0.5)
+
+        start = time.time()
+        self.assertRaises(dns.exception.Timeout, transport.query, self.qname, 'TXT')
+        self.assertLess(time.time() - start, 1.0)
+        self.assertGreater(server.queries, 1)
+
+    def test_servfail_not_retried(self):
+        server = self._server('127.0.0.1', rcode=dns.rcode.SERVFAIL)
+        transport = odup.ODUPTransport(['127.0.0.1'], port=PORT)
+
+        self.assertRaises(dns.resolver.NoNameservers, transport.query, self.qname, 'TXT')
+        self.assertEqual(server.queries, 1)
+
+    def test_tcp_failure_reported(self):
+        # nothing listens on the TCP port
+        self._server('127.0.0.1', truncate=True)
+        transport = odup.ODUPTransport(['127.0.0.1'], port=PORT)
+
+        response, error = transport._query_and_measure('127.0.0.1', self.qname, dns.rdatatype.TXT, dns.rdataclass.IN, 1.0)
+        self.assertIsNone(response)
+        self.assertEqual(error[:3], ('127.0.0.1', True, PORT))
+
+class ODUPTransportUpstreamSelectionTestCase(StandInServerTestCase):
+
+    def test_prefers_fastest(self):
+        slow = self._server('127.0.0.1', delay=0.2)
+        fast = self._server('127.0.0.2')
+        transport = odup.ODUPTransport(['127.0.0.1', '127.0.0.2'], port=PORT)
+
+        # each unmeasured server is tried once, in the configured order
+        self._timed_query(transport)
+        self._timed_query(transport)
+        self.assertEqual(transport._ordered_nameservers(), ['127.0.0.2', '127.0.0.1'])
+        queries = slow.queries
+        for i in range(5):
+            self.assertLess(self._timed_query(transport), 0.1)
+        self.assertEqual(slow.queries, queries)
+
+    def test_hedged_query(self):
+        slow = self._server('127.0.0.1', delay=3.0)
+        fast = self._server('127.0.0.2')
+        transport = odup.ODUPTransport(['127.0.0.1', '127.0.0.2'], port=PORT, hedge_delay=0.05)
+        # note which thread queries each server
+        calls = []
+        query_and_measure = transport._query_and_measure
+        def _query_and_measure(nameserver, *args):
+            calls.append((nameserver, threading.current_thread() is main_thread))
+            return query_and_measure(nameserver, *args)
+        transport._query_and_measure = _query_and_measure
+        main_thread = threading.current_thread()
+
+        # the fast server answers long before the slow one would
+        self.assertLess(self._timed_query(transport), 1.5)
+        self.assertEqual(calls, [('127.0.0.1', True), ('127.0.0.2', False)])
+        self.assertEqual(transport._ordered_nameservers(), ['127.0.0.2', '127.0.0.1'])
+
+        # with the fast server preferred, nothing is hedged, and no threads
+        # are started
+        del calls[:]
+        for i in range(5):
+            self._timed_query(transport)
+        self.assertEqual(calls, [('127.0.0.2', True)] * 5)
+        self.assertEqual(slow.queries, 1)
+        self.assertEqual(fast.queries, 6)
+
+    def test_hedge_several(self):
+        slow = self._server('127.0.0.1', delay=3.0)
+        slower = self._server('127.0.0.2', delay=3.0)
+        fast = self._server('127.0.0.3')
+        transport = odup.ODUPTransport(['127.0.0.1', '127.0.0.2', '127.0.0.3'], port=PORT, hedge_delay=0.05)
+
+        self.assertLess(self._timed_query(transport), 1.5)
+        self.assertEqual((slow.queries, slower.queries, fast.queries), (1, 1, 1))
+        self.assertEqual(transport._ordered_nameservers()[0], '127.0.0.3')
+
+    def test_failure_backoff(self):
+        failing = self._server('127.0.0.1', rcode=dns.rcode.SERVFAIL)
+        good = self._server('127.0.0.2')
+        transport = odup.ODUPTransport(['127.0.0.1', '127.0.0.2'], port=PORT)
+
+        self._timed_query(transport)
+        self.assertEqual(failing.queries, 1)
+        self.assertEqual(transport._ordered_nameservers(), ['127.0.0.2', '127.0.0.1'])
+        for i in range(5):
+            self._timed_query(transport)
+        self.assertEqual(failing.queries, 1)
+
+    def test_idle_srtt_decays(self):
+        slow = self._server('127.0.0.1', delay=0.1)
+        fast = self._server('127.0.0.2')
+        transport = odup.ODUPTransport(['127.0.0.1', '127.0.0.2'], port=PORT, srtt_halflife=0.05)
+
+        self._timed_query(transport)
+        self._timed_query(transport)
+        self.assertEqual(transport._ordered_nameservers()[0], '127.0.0.2')
+
+        # the fast server keeps answering, but once the slow one has been
+        # idle long enough, it is probed again
+        queries = slow.queries
+        time.sleep(1.0)
+        transport._record_success('127.0.0.2', 0.01)
+        self.assertEqual(transport._ordered_nameservers()[0], '127.0.0.1')
+        self._timed_query(transport)
+        self.assertEqual(slow.queries, queries + 1)
+
+def _dump(realm):
+    # Return a sorted list of (labels, policy) for each name in the realm.
+    items = []
+    nodes = [((), realm._root)]
+    while nodes:
+        labels, node = nodes.pop()
+        items.append((labels, node.policy))
+        if node.children is not None:
+            for label, child in node.children.items():
+                nodes.append(((label,) + labels, child))
+    return sorted(items)
+
+def _add_zone(realms, origin, filename, aggregate):
+    # Load a realm file with dns.zone, as before the streaming loader.
+    z = dns.zone.from_file(filename, dns.name.from_text('_odup', origin))
+    for name, ttl, rdata in z.iterate_rdatas():
+        if aggregate:
+            if name == dns.name.empty:
+                continue
+            suffix = dns.name.Name(name[-1:]).derelativize(origin)
+            name = dns.name.Name(name[:-1])
+        else:
+            suffix = origin
+        if suffix not in realms:
+            realms[suffix] = odup.ODUPPolicyRealm(suffix)
+        realms[suffix].add_policy_from_rdata(name, rdata)
+    for realm in realms.values():
+        realm.add_default_policy()
+    return realms
+
+ZONE = '''$TTL 3600
+@ IN SOA a.example. root.example. ( 1 1800 900
+        604800 86400 )
+  NS a.example.
+ns.example. A 192.0.2.1
+esc TXT "v=odup1 -httpcookie \\"quoted\\" back\\\\slash semi\\059colon"
+multi TXT "v=odup1 " "+org"
+paren TXT ( "v=odup1"
+    " +bound" ) ; comment
+ttlclass 300 IN TXT "v=odup1 +org"
+notodup TXT "hello"
+ TXT "v=odup1 -all"
+a.b.c A 192.0.2.2
+*.w TXT "v=odup1 +org"
+$ORIGIN sub._odup.example.com.
+x TXT "v=odup1 +org"
+$INCLUDE %(include)s
+$INCLUDE %(include)s other._odup.example.com.
+$GENERATE 1-3 gen$ TXT v=odup1
+$GENERATE 0-10/5 g${1,3,d} A 192.0.2.$
+'''
+
+INCLUDED_ZONE = '''inc TXT "v=odup1 +org"
+'''
+
+AGGREGATE_ZONE = '''$TTL 3600
+@ SOA a.example. root.example. 1 1800 900 604800 86400
+@ NS a.example.
+com TXT "v=odup1 +bound -all"
+example.com TXT "v=odup1 +org"
+net TXT "v=odup1 +bound +fetch:axfr:// -all"
+*.jp TXT "v=odup1 +bound:2"
+'''
+
+class ODUPPolicyRealmLoadingTestCase(unittest.TestCase):
+    # The streaming loader must build the same realms as dns.zone did.
+    origin = dns.name.from_text('example.com')
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _file(self, name, contents):
+        filename = os.path.join(self.dir, name)
+        with open(filename, 'w') as fh:
+            fh.write(contents)
+        return filename
+
+    def _zone_file(self, contents=ZONE):
+        include = self._file('included', INCLUDED_ZONE)
+        return self._file('zone', contents % {'include': include})
+
+    def test_matches_dns_zone(self):
+        filename = self._zone_file()
+        realm = odup.ODUPPolicyRealm.from_file(self.origin, filename)
+        expected = _add_zone({}, self.origin, filename, False)[self.origin]
+        self.assertEqual(_dump(realm), _dump(expected))
+
+        policies = dict(_dump(realm))
+        self.assertEqual(policies[('esc',)], r'v=odup1 -httpcookie \"quoted\" back\\slash semi;colon')
+        self.assertEqual(policies[('multi',)], 'v=odup1 " "+org')
+        self.assertEqual(policies[('notodup',)], 'v=odup1 -all')
+        self.assertEqual(policies[('inc', 'other')], 'v=odup1 +org')
+        self.assertEqual(policies[('gen2', 'sub')], 'v=odup1')
+        self.assertIn((('g011', 'sub'), None), _dump(realm))
+        self.assertNotIn(('ns',), policies)
+        self.assertNotIn(('ns', 'example'), policies)
+
+    def test_class_before_ttl(self):
+        # dns.zone only accepts the TTL first
+        realm = odup.ODUPPolicyRealm.from_file(self.origin,
+                self._zone_file(ZONE.replace('300 IN TXT', 'IN 300 TXT')))
+        expected = _add_zone({}, self.origin, self._zone_file(), False)[self.origin]
+        self.assertEqual(_dump(realm), _dump(expected))
+
+    def test_generate_modifiers(self):
+        filename = self._file('zone', '''@ SOA a.example. root.example. 1 1800 900 604800 86400
+$GENERATE 10-11 h${0,2,x} TXT "v=odup1 +org:$"
+$GENERATE 1-1 \\$${-1} A 192.0.2.1
+''')
+        policies = dict(_dump(odup.ODUPPolicyRealm.from_file(self.origin, filename)))
+        self.assertEqual(policies[('h0a',)], 'v=odup1 +org:10')
+        self.assertEqual(policies[('h0b',)], 'v=odup1 +org:11')
+        self.assertIn(('$0',), policies)
+
+    def test_aggregate_matches_dns_zone(self):
+        filename = self._file('aggregate', AGGREGATE_ZONE)
+        realms = odup.ODUPPolicyRealm.from_aggregate_file(dns.name.root, filename)
+        expected = _add_zone({}, dns.name.root, filename, True)
+        self.assertEqual(sorted(realms), sorted(expected))
+        for suffix in realms:
+            self.assertEqual(_dump(realms[suffix]), _dump(expected[suffix]))
+
+class FakeAnswer(object):
+    def __init__(self, name, rdtype, text):
+        self.rrset = dns.rrset.from_text(name, 300, 'IN', rdtype, text)
+        self.expiration = time.time() + 300
+
+class FakeResolver(object):
+    # Answers _odup TXT queries from a dict of policies, and SOA queries
+    # with the current serial; everything else is NXDOMAIN.
+
+    def __init__(self, policies):
+        self.policies = policies
+        self.serial = 1
+        self.timeout = 2.0
+        self.queries = 0
+
+    def query(self, qname, rdtype):
+        self.queries += 1
+        if rdtype == dns.rdatatype.SOA:
+            return FakeAnswer(qname, 'SOA', 'a.example. root.example. %d 1800 900 604800 86400' % (self.serial))
+        if qname in self.policies:
+            return FakeAnswer(qname, 'TXT', '"%s"' % (self.policies[qname]))
+        raise dns.resolver.NXDOMAIN
+
+class FakeTransfer(object):
+    def __init__(self, message):
+        self.answer = [
+            dns.rrset.from_text(dns.name.empty, 300, 'IN', 'SOA', 'a.example. root.example. %d 1800 900 604800 86400' % (message)),
+            dns.rrset.from_text(dns.name.from_text('example', None), 300, 'IN', 'TXT', '"v=odup1 +org"'),
+        ]
+
+class ODUPResolverLocalizeTestCase(unittest.TestCase):
+    origin = dns.name.from_text('com')
+
+    def setUp(self):
+        self.resolver = FakeResolver({dns.name.from_text('_odup.com'): 'v=odup1 +bound +fetch:axfr:// -all'})
+        self.transfers = 0
+        self.transfer_error = None
+        self._get_odup_zone = odup2psl.get_odup_zone
+        odup2psl.get_odup_zone = self._fake_get_odup_zone
+        self.scheduled = []
+
+    def tearDown(self):
+        odup2psl.get_odup_zone = self._get_odup_zone
+
+    def _fake_get_odup_zone(self, odup_name, resolver, timeout=None, lifetime=None):
+        self.assertIsNotNone(timeout)
+        self.assertIsNotNone(lifetime)
+        self.transfers += 1
+        if self.transfer_error is not None:
+            raise self.transfer_error
+        return [FakeTransfer(self.resolver.serial)]
+
+    def _odup_resolver(self, threshold=3):
+        r = odup.ODUPResolver(resolver=self.resolver, localize_threshold=threshold)
+        # run transfers on demand, rather than from timers
+        r._schedule_localize = lambda origin, delay: self.scheduled.append((origin, delay))
+        return r
+
+    def test_threshold(self):
+        r = self._odup_resolver()
+        r.resolve(dns.name.from_text('a.com'))
+        r.resolve(dns.name.from_text('b.com'))
+        self.assertEqual(self.scheduled, [])
+        r.resolve(dns.name.from_text('c.com'))
+        self.assertEqual(self.scheduled, [(self.origin, 0)])
+        r.resolve(dns.name.from_text('d.com'))
+        self.assertEqual(len(self.scheduled), 1)
+
+        r._localize(self.origin)
+        self.assertEqual(self.scheduled[-1], (self.origin, 1800))
+        queries = self.resolver.queries
+        response = r.resolve(dns.name.from_text('example.com'))
+        self.assertEqual(response.org_domain, dns.name.from_text('example.com'))
+        # the realm is resolved locally; only _odup.example.com is looked up
+        self.assertEqual(self.resolver.queries, queries + 1)
+
+    def test_refresh(self):
+        r = self._odup_resolver()
+        r._localize(self.origin)
+        realm = r._local_policies[self.origin]
+
+        # the serial hasn't changed, so there is no new transfer
+        r._localize(self.origin)
+        self.assertEqual(self.transfers, 1)
+        self.assertIs(r._local_policies[self.origin], realm)
+        self.assertEqual(self.scheduled, [(self.origin, 1800)] * 2)
+
+        self.resolver.serial = 2
+        r._localize(self.origin)
+        self.assertEqual(self.transfers, 2)
+        self.assertIsNot(r._local_policies[self.origin], realm)
+        self.assertEqual(r._localized[self.origin][0].serial, 2)
+
+    def test_expire(self):
+        r = self._odup_resolver()
+        r._localize(self.origin)
+
+        # the realm is kept until it expires, and the transfer is retried
+        self.resolver.serial = 2
+        self.transfer_error = dns.exception.Timeout()
+        r._localize(self.origin)
+        self.assertIn(self.origin, r._local_policies)
+        self.assertEqual(self.scheduled[-1], (self.origin, 900))
+
+        soa, expiration = r._localized[self.origin]
+        r._localized[self.origin] = (soa, time.time() - 1)
+        r._localize(self.origin)
+        self.assertNotIn(self.origin, r._local_policies)
+        self.assertNotIn(self.origin, r._localized)
+        self.assertNotIn(self.origin, r._localizing)
+
+    def test_failure_backoff(self):
+        r = self._odup_resolver(threshold=1)
+        self.transfer_error = dns.exception.FormError()
+        r.resolve(dns.name.from_text('a.com'))
+        r._localize(self.origin)
+        self.assertEqual(self.transfers, 1)
+        self.assertNotIn(self.origin, r._localizing)
+
+        # lookups during the backoff don't start another transfer
+        for i in range(5):
+            r.resolve(dns.name.from_text('a.com'))
+        self.assertEqual(len(self.scheduled), 1)
+
+        failures, retry = r._localize_failures[self.origin]
+        r._localize_failures[self.origin] = (failures, time.time() - 1)
+        r.resolve(dns.name.from_text('a.com'))
+        self.assertEqual(len(self.scheduled), 2)
+        r._localize(self.origin)
+        failures, retry = r._localize_failures[self.origin]
+        self.assertEqual(failures, 2)
+        self.assertGreater(retry - time.time(), odup.ODUPResolver.LOCALIZE_BACKOFF_BASE * 1.5)
+
+        # a successful transfer clears the backoff
+        self.transfer_error = None
+        r._localize_failures[self.origin] = (failures, time.time() - 1)
+        r.resolve(dns.name.from_text('a.com'))
+        r._localize(self.origin)
+        self.assertIn(self.origin, r._local_policies)
+        self.assertNotIn(self.origin, r._localize_failures)
+
+class Abort(BaseException):
+    pass
+
+class SlowResolver(FakeResolver):
+    # Holds every query until released.
+
+    def __init__(self, policies, error=None):
+        super(SlowResolver, self).__init__(policies)
+        self.error = error
+        self.release = threading.Event()
+
+    def query(self, qname, rdtype):
+        self.release.wait()
+        if self.error is not None:
+            self.queries += 1
+            raise self.error
+        return super(SlowResolver, self).query(qname, rdtype)
+
+class ODUPResolverCoalescingTestCase(unittest.TestCase):
+    qname = dns.name.from_text('_odup.example.com')
+
+    def _query_concurrently(self, resolver, count):
+        r = odup.ODUPResolver(resolver=resolver)
+        results = []
+        def _query():
+            try:
+                results.append(r._query_policy(self.qname))
+            except BaseException, e:
+                results.append(e)
+        threads = [threading.Thread(target=_query) for i in range(count)]
+        for t in threads:
+            t.start()
+        # let every thread join the outstanding query before it completes
+        time.sleep(0.2)
+        resolver.release.set()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_coalesced(self):
+        resolver = SlowResolver({self.qname: 'v=odup1 +org'})
+        results = self._query_concurrently(resolver, 20)
+        self.assertEqual(results, ['v=odup1 +org'] * 20)
+        self.assertEqual(resolver.queries, 1)
+
+    def test_error_shared(self):
+        resolver = SlowResolver({}, error=Abort())
+        results = self._query_concurrently(resolver, 20)
+        self.assertEqual(len(results), 20)
+        for result in results:
+            self.assertIsInstance(result, Abort)
+        self.assertEqual(resolver.queries, 1)
+
+class ODUPAnswerCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'cache.db')
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        shutil.rmtree(self.dir)
+
+    def _cache(self, **kwargs):
+        cache = odup.ODUPAnswerCache(self.filename, **kwargs)
+        self.caches.append(cache)
+        return cache
+
+    def _negative_response(self, ttl, minimum):
+        response = dns.message.make_response(dns.message.make_query('_odup.example.com', 'TXT'))
+        response.authority.append(dns.rrset.from_text('example.com', ttl, 'IN', 'SOA',
+                'a.example. root.example. 1 1800 900 604800 %d' % (minimum)))
+        return response
+
+    def test_warm_start(self):
+        cache = self._cache()
+        now = time.time()
+        cache.put(dns.name.from_text('a._odup.example.com'), cache.NOERROR, 'v=odup1 +org', now + 300)
+        cache.put(dns.name.from_text('b._odup.example.com'), cache.NXDOMAIN, None, now + 300)
+        cache.put(dns.name.from_text('c._odup.example.com'), cache.NOERROR, 'v=odup1', now + 0.1)
+        cache.close()
+        time.sleep(0.2)
+
+        cache = self._cache()
+        self.assertEqual(cache.get(dns.name.from_text('a._odup.example.com')), (cache.NOERROR, 'v=odup1 +org'))
+        self.assertEqual(cache.get(dns.name.from_text('b._odup.example.com')), (cache.NXDOMAIN, None))
+        # expired entries aren't loaded
+        self.assertEqual(len(cache), 2)
+
+    def test_expiry(self):
+        cache = self._cache()
+        name = dns.name.from_text('a._odup.example.com')
+        cache.put(name, cache.NOERROR, 'v=odup1 +org', time.time() + 0.1)
+        self.assertEqual(cache.get(name), (cache.NOERROR, 'v=odup1 +org'))
+        time.sleep(0.2)
+        self.assertIsNone(cache.get(name))
+        self.assertEqual(len(cache), 0)
+
+    def test_negative_ttl(self):
+        # the lesser of the SOA TTL and minimum (RFC 2308)
+        cache = self._cache()
+        for ttl, minimum in ((3600, 60), (30, 60)):
+            name = dns.name.from_text('%d._odup.example.com' % (ttl))
+            now = time.time()
+            cache.put_negative(name, cache.NXDOMAIN, self._negative_response(ttl, minimum))
+            self.assertEqual(cache.get(name), (cache.NXDOMAIN, None))
+            self.assertAlmostEqual(cache._entries[name][2], now + min(ttl, minimum), delta=1.0)
+
+        # without an SOA, nothing is cached
+        name = dns.name.from_text('no-soa._odup.example.com')
+        response = dns.message.make_response(dns.message.make_query(name, 'TXT'))
+        cache.put_negative(name, cache.NODATA, response)
+        self.assertIsNone(cache.get(name))
+
+    def test_max_entries(self):
+        cache = self._cache(max_entries=10)
+        now = time.time()
+        names = [dns.name.from_text('%d._odup.example.com' % (i)) for i in range(25)]
+        for i, name in enumerate(names):
+            cache.put(name, cache.NOERROR, 'v=odup1', now + 300 + i)
+        cache.flush()
+        self.assertLessEqual(len(cache), 10)
+        cache.close()
+
+        # those closest to expiring are the ones trimmed
+        conn = sqlite3.connect(self.filename)
+        try:
+            rows = conn.execute('SELECT name FROM odup_answers').fetchall()
+        finally:
+            conn.close()
+        self.assertEqual(sorted([dns.name.from_text(row[0]) for row in rows]), sorted(names[-10:]))
+        self.assertEqual(len(self._cache(max_entries=10)), 10)
+
+    def test_reopen_for_writing(self):
+        class FlakyCache(odup.ODUPAnswerCache):
+            REOPEN_INTERVAL = 0.0
+            failed = False
+            def _connect(self):
+                # the writer's first attempt fails
+                if threading.current_thread() is getattr(self, '_writer', None) and not self.failed:
+                    self.failed = True
+                    raise sqlite3.OperationalError('unavailable')
+                return odup.ODUPAnswerCache._connect(self)
+
+        cache = FlakyCache(self.filename)
+        self.caches.append(cache)
+        name = dns.name.from_text('a._odup.example.com')
+        cache.put(name, cache.NOERROR, 'v=odup1', time.time() + 300)
+        cache.flush()
+        self.assertTrue(cache.failed)
+        self.assertEqual(self._cache().get(name), (cache.NOERROR, 'v=odup1'))
+
+    def test_put_after_close(self):
+        cache = self._cache()
+        cache.close()
+        name = dns.name.from_text('a._odup.example.com')
+        cache.put(name, cache.NOERROR, 'v=odup1', time.time() + 300)
+        self.assertIsNone(cache.get(name))
+        # returns rather than waiting for a writer that is gone
+        cache.flush()
+        cache.close()
+
+if __name__ == '__main__':
+    unittest.main()